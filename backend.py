@@ -1,10 +1,16 @@
-import base64
+import asyncio
+import hashlib
+import logging
 import os
 import time
-import requests
-from fastapi import FastAPI, UploadFile, File, Form
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import httpx
+import orjson
+import pybase64
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 import uvicorn
 from typing import List
 import random
@@ -15,43 +21,323 @@ def sample_prompts(mode: str, count: int | None = None):
     """Return up to `count` prompts for a mode (all if count is None).
     Safeguards against IndexError if prompt lists are shortened.
     """
-    plist = PROMPTS.get(mode, []) or []
+    plist = PROMPTS.get(mode, ()) or ()
     if count is None or count >= len(plist):
         return plist
     return plist[:count]
 
+class ORJSONResponse(Response):
+    """JSON response rendered with orjson (fastapi.responses.ORJSONResponse is deprecated)."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+logger = logging.getLogger(__name__)
+
 # === FastAPI Backend for Nano Banana ===
 API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
+UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+FILES_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+# Uploads above this size go through the Files API as raw bytes instead of inline base64
+INLINE_IMAGE_LIMIT = int(os.getenv("INLINE_IMAGE_LIMIT", str(256 * 1024)))
+
+# Shared upstream client: one connection pool per worker instead of a fresh
+# TCP+TLS handshake for every Gemini call. HTTP/2 multiplexes concurrent calls
+# (e.g. ad/scene variations) over a single connection.
+client: httpx.AsyncClient | None = None
+# Bound in-flight Gemini calls per worker so bursts queue here instead of
+# turning into 429 storms upstream.
+_gemini_sem = asyncio.Semaphore(int(os.getenv("GEMINI_CONCURRENCY", "32")))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    client = httpx.AsyncClient(
+        http2=True,
+        # Fail fast on connect; a stuck upstream read can't hang a worker forever
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+    )
+    try:
+        yield
+    finally:
+        await client.aclose()
+
+# Per-file cap, and a whole-request cap sized for /merge_images' five files
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(5 * MAX_UPLOAD_BYTES)))
+
+class PayloadTooLarge(HTTPException):
+    """413 for oversized bodies/uploads. Subclasses HTTPException so FastAPI's
+    form parsing re-raises it instead of turning it into a 400.
+    """
+
+    def __init__(self, message: str = "Request body too large"):
+        super().__init__(status_code=413, detail=message)
+
+def payload_too_large_response(exc: PayloadTooLarge):
+    return ORJSONResponse({"error": exc.detail}, status_code=413)
+
+class RequestSizeLimitMiddleware:
+    """Reject oversized request bodies before they are parsed or spooled.
+    Declared Content-Length is checked up front; chunked bodies are counted
+    as they stream in.
+    """
 
-app = FastAPI()
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > self.max_bytes:
+                response = payload_too_large_response(PayloadTooLarge())
+                await response(scope, receive, send)
+                return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise PayloadTooLarge()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# Added first so CORS wraps it and its 413s still carry CORS headers
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])  # For Streamlit frontend
 
-def b64encode_file(file: UploadFile):
-    data = file.file.read()
+@app.exception_handler(PayloadTooLarge)
+async def payload_too_large_handler(request: Request, exc: PayloadTooLarge):
+    return payload_too_large_response(exc)
+
+# Upper bound on a single Retry-After wait so one 429 can't park a request for minutes
+MAX_RETRY_WAIT = float(os.getenv("MAX_RETRY_WAIT", "30"))
+
+class RateLimited(Exception):
+    """Gemini kept answering 429 after all retries."""
+
+    def __init__(self, message: str, retry_after: str | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+@app.exception_handler(RateLimited)
+async def rate_limited_handler(request: Request, exc: RateLimited):
+    headers = {"Retry-After": exc.retry_after} if exc.retry_after else None
+    return ORJSONResponse({"error": str(exc), "code": "agent.rate_limited"}, status_code=429, headers=headers)
+
+class UpstreamError(Exception):
+    """Gemini could not be reached: 504 on timeout, 502 on other transport errors."""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+@app.exception_handler(UpstreamError)
+async def upstream_error_handler(request: Request, exc: UpstreamError):
+    return ORJSONResponse({"error": str(exc)}, status_code=exc.status_code)
+
+def retry_delay(res: httpx.Response, attempt: int, backoff: float) -> float:
+    """Honor the upstream Retry-After (seconds) if present, else jittered backoff."""
+    retry_after = res.headers.get("Retry-After")
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = backoff ** attempt + random.random() * 0.5
+    return min(max(delay, 0.0), MAX_RETRY_WAIT)
+
+# Multiple of 3 so each chunk encodes to whole base64 quanta (no padding mid-stream)
+READ_CHUNK_SIZE = 65_535 * 3
+
+def _too_large():
+    return PayloadTooLarge(f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+
+def check_upload_size(file: UploadFile):
+    """Reject an oversized upload before anything reads it (hashing, encoding, uploading)."""
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise _too_large()
+
+# Read buffers are recycled across requests instead of allocating a fresh
+# bytes object per chunk; each encode borrows one for its whole read loop.
+SCRATCH_POOL_SIZE = 16
+_scratch_pool: List[bytearray] = []
+
+def _acquire_scratch() -> bytearray:
+    try:
+        return _scratch_pool.pop()
+    except IndexError:
+        return bytearray(READ_CHUNK_SIZE)
+
+def _release_scratch(buf: bytearray):
+    if len(_scratch_pool) < SCRATCH_POOL_SIZE:
+        _scratch_pool.append(buf)
+
+def _b64encode_stream(stream) -> bytearray:
+    encoded = bytearray()
+    total = 0
+    buf = _acquire_scratch()
+    view = memoryview(buf)
+    try:
+        while True:
+            n = stream.readinto(buf)
+            if not n:
+                break
+            total += n
+            if total > MAX_UPLOAD_BYTES:
+                raise _too_large()
+            # SIMD (AVX2/AVX-512) encoder; kept as ASCII bytes, never decoded to str
+            encoded += pybase64.b64encode(view[:n])
+    finally:
+        view.release()
+        _release_scratch(buf)
+    return encoded
+
+async def b64encode_file(file: UploadFile):
+    """Base64-encode an upload chunk by chunk instead of reading it whole.
+    Returns the encoded bytes (not str) so they can be spliced straight into
+    the request body by build_payload.
+    The read/encode loop runs on a worker thread so large uploads don't
+    stall the event loop.
+    """
+    await file.seek(0)
+    data = await asyncio.to_thread(_b64encode_stream, file.file)
     mime = file.content_type or "image/png"
-    return base64.b64encode(data).decode('utf-8'), mime
+    return data, mime
+
+async def _iter_file(file: UploadFile):
+    await file.seek(0)
+    total = 0
+    while True:
+        chunk = await file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > MAX_UPLOAD_BYTES:
+            raise _too_large()
+        yield chunk
+
+async def upload_file(api_key: str, file: UploadFile):
+    """Upload raw bytes to the Gemini Files API (resumable protocol).
+    Returns the uploaded file resource (`name`, `uri`, ...), or None if the
+    upload failed.
+    """
+    mime = file.content_type or "image/png"
+    async with _gemini_sem:
+        return await _upload_file(api_key, file, mime)
+
+async def _upload_file(api_key: str, file: UploadFile, mime: str):
+    start = await client.post(
+        UPLOAD_URL,
+        params={"key": api_key},
+        content=orjson.dumps({'file': {'display_name': file.filename or "upload"}}),
+        headers={
+            "Content-Type": "application/json",
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(file.size),
+            "X-Goog-Upload-Header-Content-Type": mime,
+        },
+    )
+    upload_url = start.headers.get("x-goog-upload-url")
+    if start.status_code != 200 or not upload_url:
+        return None
+    res = await client.post(
+        upload_url,
+        content=_iter_file(file),
+        headers={
+            "Content-Length": str(file.size),
+            "X-Goog-Upload-Offset": "0",
+            "X-Goog-Upload-Command": "upload, finalize",
+        },
+    )
+    if res.status_code != 200:
+        return None
+    try:
+        uploaded = orjson.loads(res.content).get('file', {})
+    except (orjson.JSONDecodeError, AttributeError):
+        # Unexpected finalize body – let load_image fall back to inline base64
+        return None
+    return uploaded if uploaded.get('uri') else None
+
+async def delete_uploads(api_key: str, images: List[dict]):
+    """Best-effort removal of Files API uploads once Gemini has used them, so
+    users' photos don't linger for 48 h or eat the project's Files quota.
+    """
+    names = {img['name'] for img in images if img.get('name')}
+
+    async def _delete(name: str):
+        async with _gemini_sem:
+            await client.delete(f"{FILES_API_BASE}/{name}", params={"key": api_key})
+
+    await asyncio.gather(*(_delete(n) for n in names), return_exceptions=True)
+
+async def load_image(api_key: str, file: UploadFile):
+    """Prepare an upload as a Gemini image reference.
+    Small images are inlined as base64; larger ones are sent as raw bytes to
+    the Files API and referenced by URI, skipping the base64 round-trip.
+    """
+    mime = file.content_type or "image/png"
+    check_upload_size(file)
+    if file.size is not None and file.size > INLINE_IMAGE_LIMIT:
+        try:
+            uploaded = await upload_file(api_key, file)
+        except httpx.HTTPError:
+            uploaded = None
+        if uploaded:
+            # `name` is kept so delete_uploads can remove it after generation
+            return {'uri': uploaded['uri'], 'name': uploaded.get('name'), 'mime': mime}
+        # Files API unavailable – fall back to inline base64
+    data, mime = await b64encode_file(file)
+    return {'data': data, 'mime': mime}
+
+def build_payload(prompt: str, images: List[dict] = None) -> bytes:
+    """Serialize a generateContent body by hand.
+    Inline image data is already base64 bytes, so it is spliced in as-is
+    rather than decoded to str and re-encoded by the JSON serializer.
+    """
+    chunks = [b'{"contents":[{"parts":[{"text":', orjson.dumps(prompt), b'}']
+    for img in images or []:
+        if 'uri' in img:
+            chunks += [b',', orjson.dumps({'fileData': {'fileUri': img['uri'], 'mimeType': img['mime']}})]
+        else:
+            chunks += [b',{"inlineData":{"mimeType":', orjson.dumps(img['mime']), b',"data":"', img['data'], b'"}}']
+    chunks.append(b']}]}')
+    return b"".join(chunks)
 
-def call_nano_banana(api_key: str, prompt: str, images: List[dict] = None, retries: int = 3, backoff: float = 1.5):
-    parts = [{'text': prompt}]
-    if images:
-        for img in images:
-            parts.append({'inlineData': {'data': img['data'], 'mimeType': img['mime']}})
+async def load_images(api_key: str, files: List[UploadFile]):
+    """load_image over several uploads concurrently, preserving order."""
+    return list(await asyncio.gather(*(load_image(api_key, f) for f in files)))
 
-    payload = {'contents': [{'parts': parts}]}
+async def call_nano_banana(api_key: str, prompt: str, images: List[dict] = None, retries: int = 3, backoff: float = 1.5):
+    payload = build_payload(prompt, images)
     attempt = 0
     while attempt <= retries:
-        res = requests.post(f"{API_URL}?key={api_key}", json=payload, headers={"Content-Type": "application/json"})
+        try:
+            async with _gemini_sem:
+                res = await client.post(API_URL, params={"key": api_key}, content=payload, headers={"Content-Type": "application/json"})
+        except httpx.TimeoutException:
+            raise UpstreamError("Upstream request timed out", status_code=504)
+        except httpx.TransportError as exc:
+            raise UpstreamError(f"Upstream request failed: {exc!r}", status_code=502)
         if res.status_code == 429:
-            # Quota / rate limit – exponential backoff
+            # Quota / rate limit – wait as told (or back off) and retry a bounded number of times
             if attempt == retries:
-                return None, res.text
-            sleep_for = backoff ** attempt
-            time.sleep(sleep_for)
+                raise RateLimited(res.text, res.headers.get("Retry-After"))
+            await asyncio.sleep(retry_delay(res, attempt, backoff))
             attempt += 1
             continue
         if res.status_code != 200:
             return None, res.text
-        data = res.json()
+        data = orjson.loads(res.content)
         parts_out = data.get('candidates', [{}])[0].get('content', {}).get('parts', [])
         for p in parts_out:
             if 'inlineData' in p:
@@ -59,135 +345,255 @@ def call_nano_banana(api_key: str, prompt: str, images: List[dict] = None, retri
         return None, "No image returned"
     return None, "Exhausted retries"
 
-@app.post("/generate")
-def generate_image(api_key: str = Form(...), prompt: str = Form(...)):
-    system_prompt = random.choice(PROMPTS["generate_image"])
-    full_prompt = f"{system_prompt} {prompt}"
-    img_b64, mime = call_nano_banana(api_key, full_prompt)
-    if img_b64:
-        return JSONResponse({"image": img_b64, "mime": mime})
-    return JSONResponse({"error": mime}, status_code=500)
+def collect_results(results_raw: list):
+    """Turn gathered call_nano_banana outcomes into response entries.
+    Failed variations (exceptions or no image) are dropped, order is kept;
+    unexpected exceptions are logged so they can still be diagnosed.
+    If nothing succeeded because Gemini rate limited us or was unreachable,
+    that is re-raised so the client gets a 429/502/504 instead of an empty list.
+    """
+    results = []
+    upstream_failure = None
+    for r in results_raw:
+        if isinstance(r, (RateLimited, UpstreamError)):
+            upstream_failure = upstream_failure or r
+            continue
+        if isinstance(r, BaseException):
+            logger.warning("Dropping failed variation", exc_info=r)
+            continue
+        img_b64, out_mime = r
+        if img_b64:
+            results.append({'image': img_b64, 'mime': out_mime})
+    if not results and upstream_failure:
+        raise upstream_failure
+    return results
 
-@app.post("/edit")
-def edit_image(api_key: str = Form(...), prompt: str = Form(...), file: UploadFile = File(...)):
-    img_data, mime = b64encode_file(file)
-    system_prompt = random.choice(PROMPTS["edit_image"])
-    full_prompt = f"{system_prompt} {prompt}"
-    img_b64, out_mime = call_nano_banana(api_key, full_prompt, images=[{'data': img_data, 'mime': mime}])
-    if img_b64:
-        return JSONResponse({"image": img_b64, "mime": out_mime})
-    return JSONResponse({"error": out_mime}, status_code=500)
+# Idempotent single-image endpoints get retried with identical inputs (UI
+# re-submits, client retries); remember recent results per worker.
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# Bounded by stored base64 bytes, not entry count: each result is a full
+# image (often 1.5–3 MB) and every worker keeps its own copy
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+_response_cache: OrderedDict = OrderedDict()
+_response_cache_bytes = 0
 
-@app.post("/virtual_try_on")
-def virtual_try_on(api_key: str = Form(...), product: UploadFile = File(...), person: UploadFile = File(...), prompt: str = Form("")):
-    images = []
-    for f in [product, person]:
-        data, mime = b64encode_file(f)
-        images.append({'data': data, 'mime': mime})
-    system_prompt = random.choice(PROMPTS["virtual_try_on"])
-    full_prompt = system_prompt
-    if prompt:
-        full_prompt += " " + prompt
-    img_b64, out_mime = call_nano_banana(api_key, full_prompt, images=images)
-    if img_b64:
-        return JSONResponse({"image": img_b64, "mime": out_mime})
-    return JSONResponse({"error": out_mime}, status_code=500)
+async def file_digest(file: UploadFile) -> str:
+    check_upload_size(file)
+    await file.seek(0)
+    digest = await asyncio.to_thread(hashlib.file_digest, file.file, "sha256")
+    await file.seek(0)
+    return digest.hexdigest()
+
+def cache_key(mode: str, api_key: str, digests: List[str], prompt: str) -> str:
+    # Scoped to the caller's key so a hit never hands one user's (billed)
+    # result to another, or to a request with a bogus key
+    key_digest = hashlib.sha256(api_key.encode()).hexdigest()
+    prompt_digest = hashlib.sha256(prompt.encode()).hexdigest()
+    return f"{mode}:{key_digest}:{','.join(digests)}:{prompt_digest}"
+
+def cache_directives(request: Request) -> set:
+    return {d.strip().lower() for d in request.headers.get("cache-control", "").split(",")}
+
+def cache_get(key: str):
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    expires, img_b64, mime = entry
+    if expires < time.monotonic():
+        _cache_evict(key)
+        return None
+    _response_cache.move_to_end(key)
+    return img_b64, mime
+
+def _cache_evict(key: str | None = None):
+    """Drop `key`, or the least recently used entry if no key is given."""
+    global _response_cache_bytes
+    if key is None:
+        _, (_, img_b64, _) = _response_cache.popitem(last=False)
+    else:
+        _, img_b64, _ = _response_cache.pop(key)
+    _response_cache_bytes -= len(img_b64)
+
+def cache_put(key: str, img_b64: str, mime: str):
+    global _response_cache_bytes
+    if len(img_b64) > RESPONSE_CACHE_MAX_BYTES:
+        return
+    if key in _response_cache:
+        _cache_evict(key)
+    _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, img_b64, mime)
+    _response_cache_bytes += len(img_b64)
+    while _response_cache_bytes > RESPONSE_CACHE_MAX_BYTES:
+        _cache_evict()
+
+def prefers_image(accept: str) -> bool:
+    """True if some image/* range in `accept` outranks every other range.
+    Browsers list image types next to text/html and */*, so a plain browser
+    request still gets JSON; only an explicit image preference wins.
+    """
+    best_image = best_other = 0.0
+    for item in accept.split(","):
+        media, *params = [p.strip() for p in item.split(";")]
+        if not media:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media.lower().startswith("image/"):
+            best_image = max(best_image, q)
+        else:
+            best_other = max(best_other, q)
+    return best_image > best_other
+
+def image_response(request: Request, img_b64: str, mime: str):
+    """JSON `{image, mime}` by default; raw image bytes when the client asks
+    for them with `?raw=1` or an `Accept` header preferring an image type,
+    which saves the client a base64 decode and a third of the bytes on the wire.
+    """
+    headers = {"Vary": "Accept"}
+    if request.query_params.get("raw") in ("1", "true") or prefers_image(request.headers.get("accept", "")):
+        return Response(content=pybase64.b64decode(img_b64), media_type=mime, headers=headers)
+    return ORJSONResponse({"image": img_b64, "mime": mime}, headers=headers)
 
 MAX_AD_VARIATIONS = int(os.getenv("MAX_AD_VARIATIONS", "3"))
 MAX_SCENE_VARIATIONS = int(os.getenv("MAX_SCENE_VARIATIONS", "3"))
 
+AD_HINTS = (
+    "lifestyle angle",
+    "dramatic lighting",
+    "portrait social feed style",
+    "product-forward macro",
+    "cinematic depth",
+    "high contrast poster feel",
+    "minimal negative space layout",
+    "moody editorial",
+    "bright commercial",
+    "subtle neutral studio",
+)
+SCENE_HINTS = (
+    "wide cinematic extension",
+    "dawn atmosphere",
+    "midday clarity",
+    "night / blue hour mood",
+    "stylized painterly reinterpretation",
+    "foggy ambient variant",
+    "high contrast sunset",
+    "rainy ambience",
+    "snowy transformation",
+    "minimal desaturated look",
+)
+
+# Per-mode behaviour for _run
+VARIATION_HINTS = {"create_ads": AD_HINTS, "generate_scenes": SCENE_HINTS}
+CACHED_MODES = {"edit_image", "virtual_try_on", "restore_old_image"}
+# The same file is often dropped in twice; encode/upload each distinct one once
+DEDUPED_MODES = {"merge_images"}
+
+def variation_prompts(system_prompt: str, hints: tuple, target: int, prompt: str = ""):
+    """Build the per-variation prompts up front, cycling through `hints`."""
+    user_suffix = f" User: {prompt.strip()}" if prompt else ""
+    return [
+        f"{system_prompt} Variation {i+1}: {hints[i % len(hints)]}.".strip() + user_suffix
+        for i in range(target)
+    ]
+
+async def _load_unique(api_key: str, files: List[UploadFile], digests: List[str]):
+    unique = {}
+    for digest, f in zip(digests, files):
+        unique.setdefault(digest, f)
+    loaded = dict(zip(unique, await load_images(api_key, list(unique.values()))))
+    return [loaded[digest] for digest in digests]
+
+async def _run(request: Request, api_key: str, mode: str, files: List[UploadFile], prompt: str, variations: int | None = None):
+    """Shared endpoint flow: prompt → (cache) → images → Gemini → response.
+    With `variations`, that many hinted prompts run concurrently and a
+    `{results: [...]}` list is returned instead of a single image.
+    """
+    system_prompt = PROMPTS[mode][0]
+    if variations is not None:
+        images = await load_images(api_key, files)
+        prompts = variation_prompts(system_prompt, VARIATION_HINTS[mode], variations, prompt)
+        # Variations are independent, so run them concurrently
+        tasks = [call_nano_banana(api_key, p, images=images) for p in prompts]
+        try:
+            results_raw = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await delete_uploads(api_key, images)
+        results = collect_results(results_raw)
+        return ORJSONResponse({"results": results[:variations]})
+
+    full_prompt = f"{system_prompt} {prompt}" if prompt else system_prompt
+    key = None
+    if mode in CACHED_MODES or mode in DEDUPED_MODES:
+        digests = list(await asyncio.gather(*(file_digest(f) for f in files)))
+    if mode in CACHED_MODES:
+        # Output varies between runs: Cache-Control: no-cache forces a fresh
+        # generation (which then replaces the cached one), no-store skips the cache
+        directives = cache_directives(request)
+        if "no-store" not in directives:
+            key = cache_key(mode, api_key, digests, full_prompt)
+        if key and "no-cache" not in directives:
+            cached = cache_get(key)
+            if cached:
+                return image_response(request, cached[0], cached[1])
+    if mode in DEDUPED_MODES:
+        images = await _load_unique(api_key, files, digests)
+    else:
+        images = await load_images(api_key, files)
+    try:
+        img_b64, out_mime = await call_nano_banana(api_key, full_prompt, images=images)
+    finally:
+        await delete_uploads(api_key, images)
+    if img_b64:
+        if key:
+            cache_put(key, img_b64, out_mime)
+        return image_response(request, img_b64, out_mime)
+    return ORJSONResponse({"error": out_mime}, status_code=500)
+
+@app.post("/generate")
+async def generate_image(request: Request, api_key: str = Form(...), prompt: str = Form(...)):
+    return await _run(request, api_key, "generate_image", [], prompt)
+
+@app.post("/edit")
+async def edit_image(request: Request, api_key: str = Form(...), prompt: str = Form(...), file: UploadFile = File(...)):
+    return await _run(request, api_key, "edit_image", [file], prompt)
+
+@app.post("/virtual_try_on")
+async def virtual_try_on(request: Request, api_key: str = Form(...), product: UploadFile = File(...), person: UploadFile = File(...), prompt: str = Form("")):
+    return await _run(request, api_key, "virtual_try_on", [product, person], prompt)
+
 @app.post("/create_ads")
-def create_ads(api_key: str = Form(...), model: UploadFile = File(...), product: UploadFile = File(...), prompt: str = Form(""), variations: int = Form(None)):
-    images = []
-    for f in [model, product]:
-        data, mime = b64encode_file(f)
-        images.append({'data': data, 'mime': mime})
+async def create_ads(request: Request, api_key: str = Form(...), model: UploadFile = File(...), product: UploadFile = File(...), prompt: str = Form(""), variations: int = Form(None)):
     # Determine how many variations to attempt
     target = variations or MAX_AD_VARIATIONS
     # Clamp to maximum of 3 variations
     target = max(1, min(target, 3))
-    system_prompt = PROMPTS["create_ads"][0]
-    base_hints = [
-        "lifestyle angle",
-        "dramatic lighting",
-        "portrait social feed style",
-        "product-forward macro",
-        "cinematic depth",
-        "high contrast poster feel",
-        "minimal negative space layout",
-        "moody editorial",
-        "bright commercial",
-        "subtle neutral studio"
-    ]
-    results = []
-    for i in range(target):
-        hint = base_hints[i % len(base_hints)]
-        full_prompt = f"{system_prompt} Variation {i+1}: {hint}.".strip()
-        if prompt:
-            full_prompt += f" User: {prompt.strip()}"
-        img_b64, out_mime = call_nano_banana(api_key, full_prompt, images=images)
-        if img_b64:
-            results.append({'image': img_b64, 'mime': out_mime})
-    return JSONResponse({"results": results})
+    return await _run(request, api_key, "create_ads", [model, product], prompt, variations=target)
 
 @app.post("/merge_images")
-def merge_images(api_key: str = Form(...), files: List[UploadFile] = File(...), prompt: str = Form("")):
-    images = []
-    for f in files[:5]:
-        data, mime = b64encode_file(f)
-        images.append({'data': data, 'mime': mime})
-    system_prompt = random.choice(PROMPTS["merge_images"])
-    full_prompt = system_prompt
-    if prompt:
-        full_prompt += " " + prompt
-    img_b64, out_mime = call_nano_banana(api_key, full_prompt, images=images)
-    if img_b64:
-        return JSONResponse({"image": img_b64, "mime": out_mime})
-    return JSONResponse({"error": out_mime}, status_code=500)
+async def merge_images(request: Request, api_key: str = Form(...), files: List[UploadFile] = File(...), prompt: str = Form("")):
+    return await _run(request, api_key, "merge_images", files[:5], prompt)
 
 @app.post("/generate_scenes")
-def generate_scenes(api_key: str = Form(...), scene: UploadFile = File(...), prompt: str = Form(""), variations: int = Form(None)):
-    data, mime = b64encode_file(scene)
+async def generate_scenes(request: Request, api_key: str = Form(...), scene: UploadFile = File(...), prompt: str = Form(""), variations: int = Form(None)):
     # Force exactly up to 3 images regardless of requested variations
-    target = 3
-    system_prompt = PROMPTS["generate_scenes"][0]
-    base_hints = [
-        "wide cinematic extension",
-        "dawn atmosphere",
-        "midday clarity",
-        "night / blue hour mood",
-        "stylized painterly reinterpretation",
-        "foggy ambient variant",
-        "high contrast sunset",
-        "rainy ambience",
-        "snowy transformation",
-        "minimal desaturated look"
-    ]
-    results = []
-    for i in range(min(target, 3)):
-        hint = base_hints[i % len(base_hints)]
-        full_prompt = f"{system_prompt} Variation {i+1}: {hint}.".strip()
-        if prompt:
-            full_prompt += f" User: {prompt.strip()}"
-        img_b64, out_mime = call_nano_banana(api_key, full_prompt, images=[{'data': data, 'mime': mime}])
-        if img_b64:
-            results.append({'image': img_b64, 'mime': out_mime})
-    # Hard truncate just in case
-    if len(results) > 3:
-        results = results[:3]
-    return JSONResponse({"results": results})
+    return await _run(request, api_key, "generate_scenes", [scene], prompt, variations=3)
 
 @app.post("/restore_old_image")
-def restore_old_image(api_key: str = Form(...), file: UploadFile = File(...), prompt: str = Form("")):
-    img_data, mime = b64encode_file(file)
-    system_prompt = random.choice(PROMPTS["restore_old_image"])
-    full_prompt = system_prompt
-    if prompt:
-        full_prompt += " " + prompt
-    img_b64, out_mime = call_nano_banana(api_key, full_prompt, images=[{'data': img_data, 'mime': mime}])
-    if img_b64:
-        return JSONResponse({"image": img_b64, "mime": out_mime})
-    return JSONResponse({"error": out_mime}, status_code=500)
+async def restore_old_image(request: Request, api_key: str = Form(...), file: UploadFile = File(...), prompt: str = Form("")):
+    return await _run(request, api_key, "restore_old_image", [file], prompt)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # One process per core; "auto" picks uvloop/httptools when installed
+    # (uvicorn[standard]) and falls back to asyncio/h11 elsewhere.
+    uvicorn.run(
+        "backend:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))),
+        loop="auto",
+        http="auto",
+    )
@@ -31,6 +31,10 @@ PROMPTS = {
     ]
 }
 
+# Immutable per-mode prompt banks; each mode currently has a single directive,
+# so the backend indexes [0] directly instead of sampling.
+PROMPTS = {mode: tuple(prompts) for mode, prompts in PROMPTS.items()}
+
 if __name__ == "__main__":
     from pprint import pprint
     pprint(PROMPTS)